@@ -31,17 +31,44 @@ GF_MORE = (1 << 5)
 GF_XYSCALE = (1 << 6)
 GF_TWOBYTWO = (1 << 7)
 
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
+from itertools import imap, izip
+from array import array
+import os
 import re
+import sys
+import threading
+
+#Parsed fonts by file name, shared by all TTFontFile instances
+_fonts = {}
+_fonts_lock = threading.Lock()
+
+
+def parse_font(file):
+    """Parsed TTFontFile for file, read once per process and again when the file changes"""
+    mtime = os.path.getmtime(file)
+    with _fonts_lock:
+        if file in _fonts and _fonts[file][0] == mtime:
+            return _fonts[file][1]
+        font = TTFontFile()
+        font.load(file)
+        _fonts[file] = (mtime, font)
+        return font
+
 
 class TTFontFile:
     def __init__(self):
         #Maximum size of glyf table to read in as string (otherwise reads each glyph from file)
         self.max_str_len_read = 200000
 
-    def get_metrics(self, file):
+    def load(self, file):
+        """Read file into memory and parse the tables needed for metrics and subsetting"""
         self.filename = file
-        self.fh = open(file,'rb')
+        fh = open(file, 'rb')
+        try:
+            self.data = fh.read()
+        finally:
+            fh.close()
         self._pos = 0
         self.char_widths = ''
         self.glyph_pos = []
@@ -60,7 +87,16 @@ class TTFontFile:
             raise RuntimeError('Not a TrueType font: version = {0}'.format(version))
         self.read_table_directory()
         self.extract_info()
-        self.fh.close()
+        self.get_LOCA(self.index_to_loc_format, self.num_glyphs)
+
+    def share(self, file):
+        """Use the parsed tables of file from the registry, with a read position of its own"""
+        self.__dict__.update(parse_font(file).__dict__)
+        self._pos = 0
+        self.otables = {}
+
+    def get_metrics(self, file):
+        self.share(file)
 
     def read_table_directory(self):
         self.num_tables = self.read_ushort()
@@ -111,29 +147,22 @@ class TTFontFile:
 
     def seek(self, pos):
         self._pos = pos
-        self.fh.seek(self._pos)
 
     def skip(self, delta):
         self._pos = self._pos + delta
-        self.fh.seek(self._pos)
 
     def seek_table(self, tag, offset_in_table = 0):
         tpos = self.get_table_pos(tag)
         self._pos = tpos[0] + offset_in_table
-        self.fh.seek(self._pos)
         return self._pos
 
     def read_tag(self):
         self._pos += 4
-        return self.fh.read(4)
+        return self.data[self._pos - 4:self._pos]
 
     def read_short(self):
         self._pos += 2
-        s = self.fh.read(2)
-        a = (ord(s[0])<<8) + ord(s[1])
-        if a & (1 << 15):
-            a = (a - (1 << 16))
-        return a
+        return unpack_from('>h', self.data, self._pos - 2)[0]
 
     def unpack_short(self, s):
         a = (ord(s[0])<<8) + ord(s[1])
@@ -143,23 +172,17 @@ class TTFontFile:
 
     def read_ushort(self):
         self._pos += 2
-        s = self.fh.read(2)
-        return (ord(s[0]) << 8) + ord(s[1])
+        return unpack_from('>H', self.data, self._pos - 2)[0]
 
     def read_ulong(self):
         self._pos += 4
-        s = self.fh.read(4)
-        return (ord(s[0]) * 16777216) + (ord(s[1]) << 16) + (ord(s[2]) << 8) + ord(s[3]) #16777216  = 1<<24
+        return unpack_from('>L', self.data, self._pos - 4)[0]
 
     def get_ushort(self, pos):
-        self.fh.seek(pos)
-        s = self.fh.read(2)
-        return (ord(s[0]) << 8) + ord(s[1])
+        return unpack_from('>H', self.data, pos)[0]
 
     def get_ulong(self, pos):
-        self.fh.seek(pos)
-        s = self.fh.read(4)
-        return (ord(s[0]) * 16777216) + (ord(s[1]) << 16) + (ord(s[2]) << 8) + ord(s[3]) #16777216  = 1<<24
+        return unpack_from('>L', self.data, pos)[0]
 
     def pack_short(self, val):
         if val < 0:
@@ -184,17 +207,15 @@ class TTFontFile:
         return self.splice(stream, offset, up)
 
     def get_chunk(self, pos, length):
-        self.fh.seek(pos)
         if length < 1:
             return ''
-        return self.fh.read(length)
+        return self.data[pos:pos + length]
 
     def get_table(self, tag):
         pos, length = self.get_table_pos(tag)
         if not length:
             raise RuntimeError('Truetype font ({0}): error reading table: {1}'.format(self.filename, tag))
-        self.fh.seek(pos)
-        return self.fh.read(length)
+        return self.data[pos:pos + length]
 
     def add(self, tag, data):
         if tag == 'head':
@@ -294,7 +315,7 @@ class TTFontFile:
         y_max = self.read_ushort()
         self.bbox = (x_min*scale, y_min*scale, x_max*scale, y_max*scale)
         self.skip(3*2)
-        index_to_loc_format = self.read_ushort()
+        self.index_to_loc_format = index_to_loc_format = self.read_ushort()
         glyph_data_format = self.read_ushort()
         if glyph_data_format:
             raise RuntimeError('Unknown glyph data format {0}'.format(glyph_data_format))
@@ -332,7 +353,7 @@ class TTFontFile:
             self.s_family_class = (sf >> 8)
             self.s_family_sub_class = (sf &0xFF)
             self._pos += 10 #PANOSE = 10 byte length
-            panose = self.fh.read(10)
+            panose = self.data[self._pos - 10:self._pos]
             self.skip(26)
             s_typo_ascender = self.read_ushort()
             s_typo_descender = self.read_ushort()
@@ -382,7 +403,7 @@ class TTFontFile:
         metric_data_format = self.read_short()
         if metric_data_format:
             raise RuntimeError('Unknown horizontal metric data format {0}'.format(metric_data_format))
-        number_of_h_metrics = self.read_ushort()
+        self.number_of_h_metrics = number_of_h_metrics = self.read_ushort()
         if not number_of_h_metrics:
             raise RuntimeError('Number of horizontal metrics is 0')
 
@@ -391,7 +412,7 @@ class TTFontFile:
 #        ///////////////////////////////////
         self.seek_table('maxp')
         self.skip(4)
-        num_glyphs = self.read_ushort()
+        self.num_glyphs = num_glyphs = self.read_ushort()
 
 #        ///////////////////////////////////
 #        // cmap - Character to glyph index mapping table
@@ -420,6 +441,8 @@ class TTFontFile:
         glyph_to_char = {}
         char_to_glyph = {}
         self.get_CMAP4(unicode_cmap_offset, glyph_to_char, char_to_glyph)
+        self.glyph_to_char = glyph_to_char
+        self.char_to_glyph = char_to_glyph
 
 #        ///////////////////////////////////
 #        // hmtx - Horizontal metrics table
@@ -430,85 +453,9 @@ class TTFontFile:
 ########################################################################################################################
 
     def make_subset(self, file, subset):
-        self.filename = file
-        self.fh = open(file, 'rb')
-        self._pos = 0
-        self.char_widths = ''
-        self.glyph_pos = []
-        self.char_to_glyph = {}
-        self.tables = {}
-        self.otables = {}
-        self.ascent = 0
-        self.descent = 0
-        self.skip(4)
+        self.share(file)
         self.max_uni = 0
-        self.read_table_directory()
-
-#        ///////////////////////////////////
-#        // head - Font header table
-#        ///////////////////////////////////
-        self.seek_table('head')
-        self.skip(50)
-        index_to_loc_format = self.read_ushort()
-        glyph_data_format = self.read_ushort()
-
-#        ///////////////////////////////////
-#        // hhea - Horizontal header table
-#        ///////////////////////////////////
-
-        self.seek_table('hhea')
-        self.skip(32)
-        metric_data_format = self.read_ushort()
-        orign_h_metrics = number_of_h_metrics = self.read_ushort()
-
-#        ///////////////////////////////////
-#        // maxp - Maximum profile table
-#        ///////////////////////////////////
-        self.seek_table('maxp')
-        self.skip(4)
-        num_glyphs = self.read_ushort()
-
-#        ///////////////////////////////////
-#        // cmap - Character to glyph index mapping table
-#        ///////////////////////////////////
-        cmap_offset = self.seek_table('cmap')
-        self.skip(2)
-        cmap_table_count = self.read_ushort()
-        unicode_cmap_offset = 0
-        for i in xrange(cmap_table_count):
-            platform_id = self.read_ushort()
-            encoding_id = self.read_ushort()
-            offset = self.read_ulong()
-            save_pos = self._pos
-            if (platform_id == 3 and encoding_id == 1) or platform_id == 0:
-                #Microsoft, Unicode
-                format = self.get_ushort(cmap_offset + offset)
-                if format == 4:
-                    unicode_cmap_offset = cmap_offset + offset
-                    break
-            self.seek(save_pos)
-
-        if not unicode_cmap_offset:
-            raise RuntimeError('Font ({0}) does not have cmap for Unicode '
-                               '(platform 3, encoding 1, format 4, or platform 0, '
-                               'any encoding, format 4)'.format(self.filename))
-        glyph_to_char = {}
-        char_to_glyph = {}
-        self.get_CMAP4(unicode_cmap_offset, glyph_to_char, char_to_glyph)
-
-        self.char_to_glyph = char_to_glyph
-
-#        ///////////////////////////////////
-#        // hmtx - Horizontal metrics table
-#        ///////////////////////////////////
-
-        scale = 1 #not used
-        self.get_HMTX(number_of_h_metrics, num_glyphs, glyph_to_char, scale)
-
-#        ///////////////////////////////////
-#        // loca - Index to location
-#        ///////////////////////////////////
-        self.get_LOCA(index_to_loc_format, num_glyphs)
+        orign_h_metrics = self.number_of_h_metrics
 
         subset_glyphs = {0:0}
         subset_char_to_glyph = {}
@@ -778,8 +725,6 @@ class TTFontFile:
         os2 = self.get_table('OS/2')
         self.add('OS/2', os2)
 
-        self.fh.close()
-
         #Put the TTF file together
         stm = self.end_tt_file('')
         return stm
@@ -824,7 +769,7 @@ class TTFontFile:
                     glyph_set[glyph_idx] = len(subset_glyphs) #old glyphID to new glyphID
                     subset_glyphs[glyph_idx] = 1
                     self.subset_glyfs_order.append(glyph_idx)
-                save_pos = self.fh.tell()
+                save_pos = self._pos
                 self.get_glyphs(glyph_idx, start, glyph_set, subset_glyphs)
                 self.seek(save_pos)
                 if flags & GF_WORDS:
@@ -843,8 +788,7 @@ class TTFontFile:
     def get_HMTX(self, number_of_h_metrics, num_glyphs, glyph_to_char, scale):
         start = self.seek_table('hmtx')
         aw = 0
-#        self.char_widths = ''.rjust(256*256*2, "\x00")
-        char_widths = ["\x00" for _i in xrange(256*256*2)]
+        char_widths = array('H', [0]) * (256*256)
         n_char_widths = 0
         if number_of_h_metrics * 4 < self.max_str_len_read:
             data = self.get_chunk(start, number_of_h_metrics * 4)
@@ -870,9 +814,8 @@ class TTFontFile:
                         w = int(round(scale * aw))
                         if not w:
                             w = 65535
-                        if char  < 196608:
-                            char_widths[char*2] = chr(w >> 8)
-                            char_widths[char*2 +1] = chr(w & 0xFF)
+                        if char < 65536:
+                            char_widths[char] = w
                             n_char_widths += 1
         data = self.get_chunk(start + number_of_h_metrics * 4, num_glyphs * 2)
         arr = unpack(">{0}H".format(len(data)/2), data)
@@ -885,28 +828,26 @@ class TTFontFile:
                         w = int(round(scale * aw))
                         if not w:
                             w = 65535
-                        if char < 196608:
-                            char_widths[char * 2] = chr(w >> 8)
-                            char_widths[char * 2 + 1] = chr(w & 0xFF)
+                        if char < 65536:
+                            char_widths[char] = w
                             n_char_widths += 1
 
         #NB 65535 is a set width of 0
         #First bytes define number of chars in font
-        char_widths[0] = chr(n_char_widths >> 8)
-        char_widths[1] = chr(n_char_widths & 0xFF)
-        self.char_widths = ''.join(char_widths)
+        char_widths[0] = n_char_widths
+        #Stored as big endian 2 byte values
+        if sys.byteorder == 'little':
+            char_widths.byteswap()
+        self.char_widths = char_widths.tostring()
 
 
     def get_h_metric(self, number_of_h_metrics, gid):
         start = self.seek_table('hmtx')
         if gid < number_of_h_metrics:
-            self.seek(start + gid * 4)
-            hm = self.fh.read(4)
+            hm = self.get_chunk(start + gid * 4, 4)
         else:
-            self.seek(start + (number_of_h_metrics - 1) * 4)
-            hm = self.fh.read(2)
-            self.seek(start + number_of_h_metrics * 2 + gid * 2)
-            hm += self.fh.read(2)
+            hm = self.get_chunk(start + (number_of_h_metrics - 1) * 4, 2)
+            hm += self.get_chunk(start + number_of_h_metrics * 2 + gid * 2, 2)
         return hm
 
     def get_LOCA(self, index_to_loc_format, num_glyphs):
@@ -929,52 +870,53 @@ class TTFontFile:
     #CMAP Format 4
     def get_CMAP4(self, unicode_cmap_offset, glyph_to_char, char_to_glyph):
         self.max_uni_char = 0
-        self.seek(unicode_cmap_offset + 2)
-        length = self.read_ushort()
+        data = self.data
+        length = self.get_ushort(unicode_cmap_offset + 2)
         limit = unicode_cmap_offset + length
-        self.skip(2)
-
-        seg_count = self.read_ushort() / 2
-        self.skip(6)
-        end_count = []
-        end_count_add = end_count.append
-        for i in xrange(seg_count):
-            end_count_add(self.read_ushort())
-        self.skip(2)
-        start_count = []
-        start_count_add = start_count.append
-        for i in xrange(seg_count):
-            start_count_add(self.read_ushort())
-        id_delta = []
-        id_delta_add = id_delta.append
-        for i in xrange(seg_count):
-            id_delta_add(self.read_short()) #???? was unsigned short
-        id_range_offset_start = self._pos
-        id_range_offset = []
-        id_range_offset_add = id_range_offset.append
-        for i in xrange(seg_count):
-            id_range_offset_add(self.read_ushort())
+        seg_count = self.get_ushort(unicode_cmap_offset + 6) / 2
+        fmt = '>{0}H'.format(seg_count)
+        pos = unicode_cmap_offset + 14
+        end_count = unpack_from(fmt, data, pos)
+        pos += seg_count * 2 + 2
+        start_count = unpack_from(fmt, data, pos)
+        pos += seg_count * 2
+        id_delta = unpack_from('>{0}h'.format(seg_count), data, pos) #???? was unsigned short
+        pos += seg_count * 2
+        id_range_offset_start = pos
+        id_range_offset = unpack_from(fmt, data, pos)
 
         for n in xrange(seg_count):
+            start = start_count[n]
             end_point = end_count[n] + 1
-            for unichar in xrange(start_count[n],end_point):
-                if not id_range_offset[n]:
-                    glyph = (unichar + id_delta[n]) & 0xFFFF
+            if start >= end_point:
+                continue
+            chars = xrange(start, end_point)
+            delta = id_delta[n]
+            if not id_range_offset[n]:
+                if 0 <= start + delta and end_point + delta <= 0x10000:
+                    glyphs = xrange(start + delta, end_point + delta)
                 else:
-                    offset = (unichar - start_count[n]) * 2 + id_range_offset[n]
-                    offset += id_range_offset_start + 2 * n
-                    if offset >= limit:
-                        glyph = 0
+                    glyphs = [(unichar + delta) & 0xFFFF for unichar in chars]
+            else:
+                #glyphIdArray entries at or past the end of the subtable map to glyph 0
+                offset = id_range_offset_start + 2 * n + id_range_offset[n]
+                count = end_point - start
+                avail = min(count, max(0, (limit - offset + 1) / 2))
+                glyphs = [(glyph + delta) & 0xFFFF if glyph else 0
+                          for glyph in unpack_from('>{0}H'.format(avail), data, offset)]
+                glyphs.extend([0] * (count - avail))
+            char_to_glyph.update(izip(chars, glyphs))
+            #glyphIdArray may map several characters of a segment to one glyph
+            distinct = not id_range_offset[n] or len(set(glyphs)) == len(glyphs)
+            if distinct and not any(imap(glyph_to_char.__contains__, glyphs)):
+                glyph_to_char.update(izip(glyphs, [[unichar] for unichar in chars]))
+            else:
+                for unichar, glyph in izip(chars, glyphs):
+                    if glyph in glyph_to_char:
+                        glyph_to_char[glyph].append(unichar)
                     else:
-                        glyph = self.get_ushort(offset)
-                        if glyph:
-                            glyph = (glyph + id_delta[n]) & 0xFFFF
-                char_to_glyph[unichar] = glyph
-                if unichar < 196608:
-                    self.max_uni_char = max(unichar, self.max_uni_char)
-                if glyph not in glyph_to_char:
-                    glyph_to_char[glyph] = []
-                glyph_to_char[glyph].append(unichar)
+                        glyph_to_char[glyph] = [unichar]
+            self.max_uni_char = max(end_point - 1, self.max_uni_char)
 
     #Put the TTF file together
     def end_tt_file(self, stm):
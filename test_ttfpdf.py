@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from ttfpdf import TTFPDF
+
+
+class TableTest(unittest.TestCase):
+
+    def table(self, pdf, header, rows):
+        pdf.set_compression(False)
+        pdf.add_page()
+        pdf.set_widths([40, 40])
+        pdf.table(rows, header=header)
+        return pdf.pages[1].getvalue()
+
+    def test_unicode_cells_with_unicode_font(self):
+        pdf = TTFPDF()
+        pdf.add_font('DejaVu', '', 'DejaVuSans.ttf', True)
+        pdf.set_font('DejaVu', '', 12)
+        page = self.table(pdf, [u'Nume', u'Oraș'], [(u'Ștefan', u'Iași'), (u'Ana', None), (3, 1.5)])
+        self.assertIn(u'Ștefan'.encode('UTF-16BE'), page)
+        self.assertIn(u'Oraș'.encode('UTF-16BE'), page)
+        self.assertIn(u'1.5'.encode('UTF-16BE'), page)
+
+    def test_unicode_cells_with_core_font(self):
+        pdf = TTFPDF()
+        pdf.set_font('Helvetica', '', 12)
+        page = self.table(pdf, [u'Nume', u'Ville'], [(u'Café', u'Besançon'), (u'Ana', None)])
+        self.assertIn('(Caf\xe9)', page)
+        self.assertIn('(Besan\xe7on)', page)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,6 +12,7 @@
 
 from datetime import datetime
 import os
+import sys
 import zlib
 import struct
 import re
@@ -19,6 +20,11 @@ import uuid
 import hashlib
 import math
 import tempfile
+import itertools
+import collections
+import threading
+import array
+import bisect
 
 try:
     # Check if PIL is available, necessary for JPEG support.
@@ -34,6 +40,14 @@ def substr(s, start, length=None):
     return s[start:start + length]
 
 
+def unpack_widths(s):
+    """Converts a table of big endian 2 byte widths to an array of unsigned shorts"""
+    cw = array.array('H', s)
+    if sys.byteorder == 'little':
+        cw.byteswap()
+    return cw
+
+
 def sprintf(fmt, *args):
     """Returns a formatted string"""
     return fmt % args
@@ -52,6 +66,180 @@ FPDF_VERSION = '1.7'
 FPDF_FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'font')
 
 
+class PDFBuffer:
+    """String buffer kept as a list of chunks, with a running length"""
+
+    def __init__(self, s=''):
+        self.chunks = [s] if s else []
+        self.length = len(s)
+
+    def write(self, s):
+        """Append a string"""
+        self.chunks.append(s)
+        self.length += len(s)
+
+    def getvalue(self):
+        """Get the whole content, chunks are joined only once"""
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0] if self.chunks else ''
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self.getvalue()
+
+
+class LRUCache:
+    """Thread safe least recently used cache, bounded by the total size of its values"""
+
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get a value and mark it as the most recently used"""
+        with self.lock:
+            try:
+                value, size = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.items[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Add a value, evicting the least recently used ones over max_size"""
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.items:
+                self.size -= self.items.pop(key)[1]
+            if size > self.max_size:
+                return
+            self.items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self.items.popitem(last=False)[1][1]
+
+    def set_max_size(self, max_size):
+        """Change the size budget, evicting values over it"""
+        with self.lock:
+            self.max_size = max_size
+            while self.size > self.max_size:
+                self.size -= self.items.popitem(last=False)[1][1]
+
+    def clear(self):
+        """Remove all values and reset the counters"""
+        with self.lock:
+            self.items.clear()
+            self.size = self.hits = self.misses = 0
+
+    def clear_items(self):
+        """Remove all values, the counters are kept"""
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.items)
+
+
+class TextLayout:
+    """Lines of text broken to fit a multi_cell, ready to be drawn"""
+
+    def __init__(self, w, wmax, h, lines):
+        self.w = w
+        self.wmax = wmax
+        self.h = h
+        #(line, number of spaces if broken at a space else None, width) for each line
+        self.breaks = lines
+        self.lines = [line for line, ns, width in lines]
+        self.widths = [width for line, ns, width in lines]
+        self.height = h * len(lines)
+
+
+class PNGAlphaSplitter:
+    """Split PNG image data with alpha into compressed color and alpha streams chunk by chunk
+
+    Only a few scanlines are decompressed at a time. Each scanline keeps its filter byte in both
+    streams, the channels are copied with strided slices.
+    """
+
+    def __init__(self, w, h, bpp, level, strategy):
+        #Bytes per pixel, the last one is alpha
+        self.bpp = bpp
+        self.length = 1 + bpp * w
+        self.color_length = 1 + (bpp - 1) * w
+        self.alpha_length = 1 + w
+        self.rows_left = h
+        #Decompress about 64 KB of scanlines at a time
+        self.limit = self.length * max(1, 65536 // self.length)
+        self.pending = ''
+        self.decompressor = zlib.decompressobj()
+        self.color = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 8, strategy)
+        self.alpha = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 8, strategy)
+        self.color_data = []
+        self.alpha_data = []
+
+    def feed(self, data):
+        """Add a chunk of compressed image data"""
+        d = self.decompressor
+        self._split(d.decompress(data, self.limit))
+        while d.unconsumed_tail:
+            self._split(d.decompress(d.unconsumed_tail, self.limit))
+
+    def close(self):
+        """Compressed color and alpha streams, None if the image data is incomplete"""
+        self._split(self.decompressor.flush())
+        if self.rows_left:
+            return None
+        self.color_data.append(self.color.flush())
+        self.alpha_data.append(self.alpha.flush())
+        return ''.join(self.color_data), ''.join(self.alpha_data)
+
+    def _split(self, data):
+        data = self.pending + data
+        length = self.length
+        rows = min(len(data) // length, self.rows_left)
+        self.pending = data[rows * length:]
+        self.rows_left -= rows
+        if not rows:
+            return
+        bpp = self.bpp
+        color_length = self.color_length
+        alpha_length = self.alpha_length
+        color = bytearray(color_length * rows)
+        alpha = bytearray(alpha_length * rows)
+        for i in xrange(rows):
+            pos = length * i
+            end = pos + length
+            cpos = color_length * i
+            apos = alpha_length * i
+            color[cpos] = alpha[apos] = data[pos]
+            for c in xrange(bpp - 1):
+                color[cpos + 1 + c:cpos + color_length:bpp - 1] = data[pos + 1 + c:end:bpp]
+            alpha[apos + 1:apos + alpha_length] = data[pos + bpp:end:bpp]
+        self.color_data.append(self.color.compress(str(color)))
+        self.alpha_data.append(self.alpha.compress(str(alpha)))
+
+
+# Compressed CIDToGIDMap streams by font file and subset, shared by all documents
+CID_TO_GID_MAP_CACHE = LRUCache(1024 * 1024)
+# Compressed TrueType subsets with their glyph mapping, by font file, mtime and code points
+SUBSET_CACHE = LRUCache(16 * 1024 * 1024, lambda value: len(value[0]))
+# Compressed color and alpha streams of PNG images, by image data digest and compression level
+PNG_ALPHA_CACHE = LRUCache(32 * 1024 * 1024, lambda value: len(value[0]) + len(value[1]))
+# Parsed images by path, mtime, size and type, shared by all documents
+IMAGE_CACHE = LRUCache(64 * 1024 * 1024, lambda info: len(info['data']) + len(info.get('smask', '')))
+
+
 class TTFPDF:
 #Private properties
 #~
@@ -59,9 +247,16 @@ class TTFPDF:
 #~ n;                  #current object number
 #~ offsets;            #array of object offsets
 #~ buffer;             #buffer holding in-memory PDF
+#~ stream_to;          #file-like object receiving the PDF instead of buffer
+#~ offset;             #number of bytes of the PDF produced so far
 #~ pages;              #array containing pages
 #~ state;              #current document state
 #~ compress;           #compression flag
+#~ compress_workers;   #number of threads compressing streams in parallel
+#~ compression_levels; #zlib level and strategy for each kind of stream
+#~ pool;               #thread pool used for parallel compression
+#~ flush_pages;        #write page contents out as soon as the page ends
+#~ page_tails;         #content of flushed pages from their first page total on, written at close
 #~ def_orientation;     #default orientation
 #~ cur_orientation;     #current orientation
 #~ orientation_changes; #array indicating orientation changes
@@ -83,12 +278,16 @@ class TTFPDF:
 #~ font_files;          #array of font files
 #~ diffs;              #array of encoding differences
 #~ images;             #array of used images
+#~ image_keys;         #used images by content, images with the same content share one info
 #~ page_links;          #array of links in pages
 #~ links;              #array of internal links
 #~ font_family;         #current font family
 #~ font_style;          #current font style
 #~ underline;          #underlining flag
 #~ current_font;        #current font info
+#~ width_cache;         #string widths by font and text, None when disabled
+#~ layout_cache;        #multi_cell lines by font, width and text, None when disabled
+#~ encode_cache;        #encoded unicode strings by font and text, None when disabled
 #~ font_size_pt;         #current font size in points
 #~ font_size;           #current font size in user unit
 #~ draw_color;          #commands for drawing color
@@ -121,13 +320,25 @@ class TTFPDF:
 # *                               Public methods                                 *
 # *                                                                              *
 # *******************************************************************************/
-    def __init__(self, orientation='P', unit='mm', size='A4'):
+    def __init__(self, orientation='P', unit='mm', size='A4', stream_to=None):
         #Some checks
         self._dochecks()
         #Initialization of properties
         self.page = 0
         self.n = 2
-        self.buffer = ''
+        self.buffer = PDFBuffer()
+        self.stream_to = stream_to
+        self.offset = 0
+        self.pool = None
+        self.pending_pages = []
+        self.page_tails = {}
+        self.compression_levels = {
+            'page': (zlib.Z_DEFAULT_COMPRESSION, zlib.Z_DEFAULT_STRATEGY),
+            'font': (zlib.Z_DEFAULT_COMPRESSION, zlib.Z_DEFAULT_STRATEGY),
+            'cidtogidmap': (zlib.Z_DEFAULT_COMPRESSION, zlib.Z_DEFAULT_STRATEGY),
+            'image': (zlib.Z_DEFAULT_COMPRESSION, zlib.Z_DEFAULT_STRATEGY),
+            'file': (9, zlib.Z_DEFAULT_STRATEGY)
+        }
         self.pages = {}
         self.page_sizes = {}
         self.state = 0
@@ -135,6 +346,7 @@ class TTFPDF:
         self.font_files = {}
         self.diffs = {}
         self.images = {}
+        self.image_keys = {}
         self.links = {}
         self.in_header = 0
         self.in_footer = 0
@@ -199,11 +411,17 @@ class TTFPDF:
         self.set_display_mode('default')
         #Enable compression
         self.set_compression(True)
+        #Keep pages until the document is closed
+        self.set_flush_pages(False)
+        #Measure strings without caching their widths
+        self.set_width_cache(0)
+        self.set_layout_cache(0)
+        self.set_encode_cache(0)
         #Set default PDF version number
         self.pdf_version = '1.3'
         self.unifont_subset = None
         self.offsets = {}
-        self.page_links = []
+        self.page_links = {}
 
         self.encrypted = False
         self.last_rc4_key = ''
@@ -259,9 +477,66 @@ class TTFPDF:
         else:
             self.error('Incorrect layout display mode: ' + layout)
 
-    def set_compression(self, compress):
-        """Set page compression"""
+    def set_compression(self, compress, workers=1):
+        """Set page compression, with workers > 1 streams are compressed in parallel threads"""
         self.compress = compress
+        if self.pool is not None and workers != self.compress_workers:
+            self.pool.close()
+            self.pool = None
+        self.compress_workers = workers
+
+    def set_compression_level(self, level, strategy=zlib.Z_DEFAULT_STRATEGY, stream=None):
+        """Set zlib level and strategy for a kind of stream (page, font, cidtogidmap, image, file) or all
+
+        The image level applies to palettes and to the color and alpha streams split from PNG
+        images with an alpha channel. Other image data is embedded as it is.
+        """
+        if not -1 <= level <= 9:
+            self.error('Incorrect compression level: {0}'.format(level))
+        if stream is None:
+            streams = self.compression_levels.keys()
+        elif stream in self.compression_levels:
+            streams = [stream]
+        else:
+            self.error('Incorrect stream type: ' + stream)
+        for stream in streams:
+            self.compression_levels[stream] = (level, strategy)
+
+    def set_flush_pages(self, flush):
+        """Write the content of each page to the output as soon as the page is finished"""
+        self.flush_pages = flush
+
+    def set_width_cache(self, size):
+        """Keep the widths of the last size strings measured, 0 disables the cache"""
+        self.width_cache = LRUCache(size, lambda value: 1) if size else None
+
+    def set_layout_cache(self, size):
+        """Keep the line breaks of the last size texts laid out, 0 disables the cache"""
+        self.layout_cache = LRUCache(size, lambda value: 1) if size else None
+
+    def set_encode_cache(self, size):
+        """Keep the last size strings encoded for unicode fonts, 0 disables the cache"""
+        self.encode_cache = LRUCache(size, lambda value: 1) if size else None
+
+    def get_font_subset(self, family, style=''):
+        """Sorted code points of a unicode font used by the document so far, None for other fonts"""
+        family = family.lower()
+        style = style.upper().replace('U', '')
+        if style == 'IB':
+            style = 'BI'
+        font = self.fonts.get(family + style)
+        if font is None or 'subset' not in font:
+            return None
+        return sorted(font['subset'])
+
+    def get_width_cache_stats(self):
+        """Hits, misses, hit rate and number of entries of the string width cache"""
+        cache = self.width_cache
+        if cache is None:
+            return None
+        lookups = cache.hits + cache.misses
+        return {'hits': cache.hits, 'misses': cache.misses, 'entries': len(cache),
+                'hit_rate': float(cache.hits) / lookups if lookups else 0.0}
 
     def set_title(self, title, is_UTF8=False):
         """Title of document"""
@@ -423,27 +698,46 @@ class TTFPDF:
 
     def get_string_width(self, s):
         """Get width of a string in the current font"""
-        cw = self.current_font['cw']
-        w = 0
-        if self.unifont_subset:
-            unicode_str = self.UTF8_string_to_array(s)
-            for char in unicode_str:
-                if char < len(cw):
-                    w += (ord(cw[2 * char]) << 8) + ord(cw[2 * char + 1])
-                elif 0 < char < 128 and chr(char) in cw:
-                    w += cw[chr(char)]
-                elif 'desc' in self.current_font and 'MissingWidth' in self.current_font['desc']:
-                    w += self.current_font['desc']['MissingWidth']
-                elif 'MissingWidth' in self.current_font:
-                    w += self.current_font['MissingWidth']
-                else:
-                    w += 500
+        if self.width_cache is None:
+            w = self._get_string_width(s)
         else:
-            l = len(s)
-            for i in xrange(l):
-                w += cw.get(s[i], 0)
+            key = (self.font_family + self.font_style, s)
+            w = self.width_cache.get(key)
+            if w is None:
+                w = self._get_string_width(s)
+                self.width_cache.set(key, w)
         return w * self.font_size / 1000.0
 
+    def _get_string_width(self, s):
+        """Get width of a string in the current font, in font units"""
+        if self.unifont_subset:
+            return sum(self._get_char_widths(map(ord, s.decode('UTF-8'))))
+        cw = self.current_font['cw']
+        w = 0
+        l = len(s)
+        for i in xrange(l):
+            w += cw.get(s[i], 0)
+        return w
+
+    def _get_char_widths(self, chars):
+        """Get widths in font units of a list of code points in the current unicode font"""
+        cw = self.current_font['cw']
+        try:
+            widths = map(cw.__getitem__, chars)
+        except IndexError:
+            if 'desc' in self.current_font and 'MissingWidth' in self.current_font['desc']:
+                missing_width = self.current_font['desc']['MissingWidth']
+            elif 'MissingWidth' in self.current_font:
+                missing_width = self.current_font['MissingWidth']
+            else:
+                missing_width = 500
+            cw_len = len(cw)
+            widths = [cw[char] if char < cw_len else missing_width for char in chars]
+        if 65535 in widths:
+            #NB 65535 is a set width of 0
+            widths = [0 if width == 65535 else width for width in widths]
+        return widths
+
     def set_line_width(self, width):
         """Set line width"""
         self.line_width = width
@@ -481,6 +775,12 @@ class TTFPDF:
         fontkey = family + style
         if fontkey in self.fonts:
             self.error('Font already added: ' + family + ' ' + style)
+        if self.width_cache is not None:
+            self.width_cache.clear_items()
+        if self.layout_cache is not None:
+            self.layout_cache.clear_items()
+        if self.encode_cache is not None:
+            self.encode_cache.clear_items()
         if uni:
             ttf_filename = os.path.join(self._getfontpath(), 'unitfont', file)
             unifilename = os.path.join(self._getfontpath(), 'unitfont', file.split('.')[0].lower())
@@ -549,15 +849,12 @@ class TTFPDF:
                 del ttf
             else:
                 cw = open(unifilename + '.cw.dat', 'rb').read()
+            cw = unpack_widths(cw)
             i = len(self.fonts) + 1
             if hasattr(self, 'str_alias_nb_pages'):
-                sbarr = {}
-                for x in xrange(0, 57):
-                    sbarr[x] = x
+                sbarr = set(xrange(0, 57))
             else:
-                sbarr = {}
-                for x in xrange(0, 32):
-                    sbarr[x] = x
+                sbarr = set(xrange(0, 32))
             self.fonts[fontkey] = dict(i=i, type=type, name=name, desc=desc, up=up, ut=ut, cw=cw,
                                        ttffile=ttffile, fontkey=fontkey, subset=sbarr, unifilename=unifilename)
 
@@ -658,9 +955,7 @@ class TTFPDF:
     def text(self, x, y, txt):
         """Output a string"""
         if self.unifont_subset:
-            txt2 = self._escape(self.UTF8_to_UTF16BE(txt, False))
-            for uni in self.UTF8_string_to_array(txt):
-                self.current_font['subset'][uni] = uni
+            txt2 = self._encode_text(txt)
         else:
             txt2 = self._escape(txt)
         s = sprintf('BT %.2f %.2f Td (%s) Tj ET', x * self.k, (self.h - y) * self.k, txt2)
@@ -672,9 +967,7 @@ class TTFPDF:
 
     def text_with_direction(self, x, y, txt, direction='R'):
         if self.unifont_subset:
-            txt2 = self._escape(self.UTF8_to_UTF16BE(txt, False))
-            for uni in self.UTF8_string_to_array(txt):
-                self.current_font['subset'][uni] = uni
+            txt2 = self._encode_text(txt)
         else:
             txt2 = self._escape(txt)
 
@@ -700,9 +993,7 @@ class TTFPDF:
 
     def text_with_rotation(self, x, y, txt, txt_angle, font_angle=0):
         if self.unifont_subset:
-            txt2 = self._escape(self.UTF8_to_UTF16BE(txt, False))
-            for uni in self.UTF8_string_to_array(txt):
-                self.current_font['subset'][uni] = uni
+            txt2 = self._encode_text(txt)
         else:
             txt2 = self._escape(txt)
 
@@ -743,6 +1034,27 @@ class TTFPDF:
                 self._out(sprintf('%.3f Tw', ws * k))
         if w == 0:
             w = self.w - self.r_margin - self.x
+        s = self._cell_ops(w, h, txt, border, align, fill, link)
+        if s:
+            self._out(s)
+        self.lasth = h
+        if ln > 0:
+            #Go to next line
+            self.y += h
+            if ln == 1:
+                self.x = self.l_margin
+        else:
+            self.x += w
+
+    def _cell_ops(self, w, h, txt, border, align, fill, link):
+        """Get the operators drawing a cell at the current position
+
+        Nothing is written to the page, but like cell() it adds the link and, with a unicode
+        font, registers the characters of txt in the font subset. These side effects are
+        intended: _draw_row joins the operators of several cells into one write and relies on
+        the characters being registered.
+        """
+        k = self.k
         s = ''
         if fill or border == 1:
             if fill:
@@ -778,8 +1090,7 @@ class TTFPDF:
 
             #If multibyte, Tw has no effect - do word spacing using an adjustment before each space
             if self.ws and self.unifont_subset:
-                for uni in self.UTF8_string_to_array(txt):
-                    self.current_font['subset'][uni] = uni
+                self._encode_text(txt)
                 space = self._escape(self.UTF8_to_UTF16BE(' ', False))
                 s += sprintf('BT 0 Tw %.2f %.2f Td [', (self.x + dx) * k,
                              (self.h - (self.y + 0.5 * h + 0.3 * self.font_size)) * k)
@@ -794,9 +1105,7 @@ class TTFPDF:
                 s += '] TJ ET'
             else:
                 if self.unifont_subset:
-                    txt2 = self._escape(self.UTF8_to_UTF16BE(txt, False))
-                    for uni in self.UTF8_string_to_array(txt):
-                        self.current_font['subset'][uni] = uni
+                    txt2 = self._encode_text(txt)
                 else:
                     txt2 = txt.replace('\\', '\\\\').replace(')', '\\)').replace('(', '\\(')
                 s += sprintf('BT %.2f %.2f Td (%s) Tj ET', (self.x + dx) * k,
@@ -808,33 +1117,37 @@ class TTFPDF:
             if link:
                 self.link(self.x + dx, self.y + .5 * h - .5 * self.font_size, self.get_string_width(txt),
                           self.font_size, link)
-        if s:
-            self._out(s)
-        self.lasth = h
-        if ln > 0:
-            #Go to next line
-            self.y += h
-            if ln == 1:
-                self.x = self.l_margin
-        else:
-            self.x += w
+        return s
 
     def multi_cell(self, w, h, txt, border=0, align='J', fill=0, split_only=False):
         """Output text with automatic or explicit line breaks"""
-        ret = [] # if split_only = True, returns splited text cells
-        cw = self.current_font['cw']
+        layout = self.layout_multi_cell(w, h, txt)
+        if split_only:
+            self.x = self.l_margin
+            return layout.lines
+        self.draw_multi_cell(layout, border, align, fill)
+        return []
+
+    def layout_multi_cell(self, w, h, txt):
+        """Break text into the lines of a multi_cell without drawing it"""
         if w == 0:
             w = self.w - self.r_margin - self.x
         wmax = (w - 2 * self.c_margin)
         s = txt.replace("\r", '')
-        if self.unifont_subset:
-            nb = mb_strlen(s, 'UTF-8')
-            while nb > 0 and mb_substr(s, nb - 1, 1, 'UTF-8') == "\n":
-                nb -= 1
+        if self.layout_cache is None:
+            lines = self._split_lines(s, wmax)
         else:
-            nb = len(s)
-            if nb > 0 and s[nb - 1] == "\n":
-                nb -= 1
+            key = (self.font_family + self.font_style, self.font_size, wmax, s)
+            lines = self.layout_cache.get(key)
+            if lines is None:
+                lines = self._split_lines(s, wmax)
+                self.layout_cache.set(key, lines)
+        return TextLayout(w, wmax, h, lines)
+
+    def draw_multi_cell(self, layout, border=0, align='J', fill=0):
+        """Output the lines of a multi_cell laid out with the current font"""
+        w = layout.w
+        h = layout.h
         b = 0
         if border:
             if border == 1:
@@ -851,114 +1164,105 @@ class TTFPDF:
                     b = b2 + 'T'
                 else:
                     b = b2
-        sep = -1
-        i = 0
-        j = 0
-        l = 0
-        ns = 0
-        nl = 1
-        while i < nb:
-            #Get next character
-            if self.unifont_subset:
-                c = mb_substr(s, i, 1, 'UTF-8')
-            else:
-                c = s[i]
-            if c == "\n":
-                #Explicit line break
+        last = len(layout.breaks) - 1
+        for n, (line, ns, ls) in enumerate(layout.breaks):
+            if ns is None:
+                #Explicit line break, break inside a word or last chunk
                 if self.ws > 0:
                     self.ws = 0
                     self._out('0 Tw')
-                if self.unifont_subset:
-                    if not split_only:
-                        self.cell(w, h, mb_substr(s, j, i - j, 'UTF-8'), b, 2, align, fill)
-                    else:
-                        ret.append(mb_substr(s, j, i - j, 'UTF-8'))
+            elif align == 'J':
+                if ns > 1:
+                    self.ws = (layout.wmax - ls) / (ns - 1)
                 else:
-                    if not split_only:
-                        self.cell(w, h, substr(s, j, i - j), b, 2, align, fill)
-                    else:
-                        ret.append(substr(s, j, i - j))
-                i += 1
-                sep = -1
-                j = i
-                l = 0
-                ns = 0
-                nl += 1
-                if border and nl == 2:
-                    b = b2
-                continue
-            if c == ' ':
-                sep = i
-                ls = l
-                ns += 1
-            if self.unifont_subset:
-                l += self.get_string_width(c)
-            else:
-                l += cw.get(c, 0) * self.font_size / 1000.0
-            if l > wmax:
-                #Automatic line break
-                if sep == -1:
-                    if i == j:
-                        i += 1
-                    if self.ws > 0:
-                        self.ws = 0
-                        self._out('0 Tw')
-                    if self.unifont_subset:
-                        if not split_only:
-                            self.cell(w, h, mb_substr(s, j, i - j, 'UTF-8'), b, 2, align, fill)
-                        else:
-                            ret.append(mb_substr(s, j, i - j, 'UTF-8'))
-                    else:
-                        if not split_only:
-                            self.cell(w, h, substr(s, j, i - j), b, 2, align, fill)
-                        else:
-                            ret.append(substr(s, j, i - j))
-                else:
-                    if align == 'J':
-                        if ns > 1:
-                            self.ws = (wmax - ls) / (ns - 1)
-                        else:
-                            self.ws = 0
-                        self._out(sprintf('%.3f Tw', self.ws * self.k))
-                    if self.unifont_subset:
-                        if not split_only:
-                            self.cell(w, h, mb_substr(s, j, sep - j, 'UTF-8'), b, 2, align, fill)
-                        else:
-                            ret.append(mb_substr(s, j, sep - j, 'UTF-8'))
-                    else:
-                        if not split_only:
-                            self.cell(w, h, substr(s, j, sep - j), b, 2, align, fill)
-                        else:
-                            ret.append(substr(s, j, sep - j))
-                    i = sep + 1
-                sep = -1
+                    self.ws = 0
+                self._out(sprintf('%.3f Tw', self.ws * self.k))
+            if n == last and border and 'B' in border:
+                b += 'B'
+            self.cell(w, h, line, b, 2, align, fill)
+            if border and n == 0:
+                b = b2
+        self.x = self.l_margin
+
+    def _split_lines(self, s, wmax):
+        """Break text into the lines of a multi_cell no wider than wmax
+
+        Returns a list of (line, ns, width). For a line broken at a space ns is the number of
+        spaces up to the break, otherwise ns is None.
+        """
+        chars, widths = self._measure_text(s)
+        nb = len(chars)
+        if self.unifont_subset:
+            while nb > 0 and chars[nb - 1] == "\n":
+                nb -= 1
+        elif nb > 0 and chars[nb - 1] == "\n":
+            nb -= 1
+        limit = wmax * 1000.0 / self.font_size
+        lines = []
+        j = 0
+        while True:
+            i, sep = self._find_break(chars, widths, nb, j, limit)
+            if i == nb:
+                break
+            if chars[i] == "\n":
+                #Explicit line break
+                lines.append((chars[j:i], None, (widths[i] - widths[j]) * self.font_size / 1000.0))
+                j = i + 1
+            elif sep == -1:
+                #Automatic line break inside a word
+                if i == j:
+                    i += 1
+                lines.append((chars[j:i], None, (widths[i] - widths[j]) * self.font_size / 1000.0))
                 j = i
-                l = 0
-                ns = 0
-                nl += 1
-                if border and nl == 2:
-                    b = b2
             else:
-                i += 1
-                #Last chunk
-        if self.ws > 0:
-            self.ws = 0
-            self._out('0 Tw')
+                #Automatic line break at the last space
+                #Summed character by character in user units like the word spacing always was
+                ls = sum([(widths[k + 1] - widths[k]) * self.font_size / 1000.0
+                          for k in xrange(j, sep)])
+                lines.append((chars[j:sep], chars.count(' ', j, i + 1), ls))
+                j = sep + 1
+        #Last chunk
+        lines.append((chars[j:nb], None, (widths[nb] - widths[j]) * self.font_size / 1000.0))
+        if self.unifont_subset:
+            lines = [(line.encode('UTF-8'), ns, width) for line, ns, width in lines]
+        return lines
 
-        if border and 'B' in border:
-            b += 'B'
+    def _measure_text(self, s):
+        """Decode a string in the current font and get the cumulative widths of its characters
+
+        widths[i] is the width in font units of the first i characters.
+        """
         if self.unifont_subset:
-            if not split_only:
-                self.cell(w, h, mb_substr(s, j, i - j, 'UTF-8'), b, 2, align, fill)
-            else:
-                ret.append(mb_substr(s, j, i - j, 'UTF-8'))
+            chars = s.decode('UTF-8')
+            char_widths = self._get_char_widths(map(ord, chars))
         else:
-            if not split_only:
-                self.cell(w, h, substr(s, j, i - j), b, 2, align, fill)
-            else:
-                ret.append(substr(s, j, i - j))
-        self.x = self.l_margin
-        return ret
+            chars = s
+            cw = self.current_font['cw']
+            char_widths = [cw.get(c, 0) for c in s]
+        widths = [0]
+        add = widths.append
+        l = 0
+        for width in char_widths:
+            l += width
+            add(l)
+        return chars, widths
+
+    def _find_break(self, chars, widths, nb, j, limit, start=None):
+        """Find where the line starting at j ends, limit being its maximum width in font units
+
+        Returns (i, sep). i is nb if the rest of the text fits, otherwise the index of the
+        newline or of the first character which does not fit. sep is the index of the last
+        space up to that character, or -1. The search begins at start if given.
+        """
+        if start is None:
+            start = j
+        i = bisect.bisect_right(widths, widths[j] + limit, start + 1, nb + 1) - 1
+        nl = chars.find("\n", start, i + 1 if i < nb else nb)
+        if nl != -1:
+            return nl, -1
+        if i == nb:
+            return nb, -1
+        return i, chars.rfind(' ', j, i + 1)
 
     def cell_fit_scale(self, w, h=0, txt='', border=0, ln=0, align='', fill=False, link=''):
         """Cell with horizontal scaling only if necessary"""
@@ -978,91 +1282,59 @@ class TTFPDF:
 
     def write(self, h, txt, link=''):
         """Output text in flowing mode"""
-        cw = self.current_font['cw']
         w = self.w - self.r_margin - self.x
         wmax = (w - 2 * self.c_margin)
         s = txt.replace("\r", '')
-        if self.unifont_subset:
-            nb = mb_strlen(s, 'UTF-8')
-            if nb == 1 and s == ' ':
-                self.x += self.get_string_width(s)
-                return
-        else:
-            nb = len(s)
-
-        sep = -1
-        i = 0
+        if self.unifont_subset and s == ' ':
+            self.x += self.get_string_width(s)
+            return
+        chars, widths = self._measure_text(s)
+        nb = len(chars)
         j = 0
-        l = 0
+        start = 0
         nl = 1
-        while i < nb:
-            #Get next character
-            if self.unifont_subset:
-                c = mb_substr(s, i, 1)
-            else:
-                c = s[i]
-            if c == "\n":
+        while True:
+            i, sep = self._find_break(chars, widths, nb, j, wmax * 1000.0 / self.font_size, start)
+            if i == nb:
+                break
+            if chars[i] == "\n":
                 #Explicit line break
-                if self.unifont_subset:
-                    self.cell(w, h, mb_substr(s, j, i - j), 0, 2, '', 0, link)
-                else:
-                    self.cell(w, h, substr(s, j, i - j), 0, 2, '', 0, link)
-                i += 1
-                sep = -1
-                j = i
-                l = 0
-                if nl == 1:
+                end = i
+                start = i + 1
+            elif sep == -1:
+                #Automatic line break inside a word
+                if self.x > self.l_margin:
+                    #Move to next line
                     self.x = self.l_margin
+                    self.y += h
                     w = self.w - self.r_margin - self.x
                     wmax = (w - 2 * self.c_margin)
-                nl += 1
-                continue
-            if c == ' ':
-                sep = i
-            if self.unifont_subset:
-                l += self.get_string_width(c)
-            else:
-                l += cw.get(c, 0) * self.font_size / 1000.0
-            if l > wmax:
-                #Automatic line break
-                if sep == -1:
-                    if self.x > self.l_margin:
-                        #Move to next line
-                        self.x = self.l_margin
-                        self.y += h
-                        w = self.w - self.r_margin - self.x
-                        wmax = (w - 2 * self.c_margin)
-                        i += 1
-                        nl += 1
-                        continue
-                    if i == j:
-                        i += 1
-                    if self.unifont_subset:
-                        self.cell(w, h, mb_substr(s, j, i - j, 'UTF-8'), 0, 2, '', 0, link)
-                    else:
-                        self.cell(w, h, substr(s, j, i - j), 0, 2, '', 0, link)
-                else:
-                    if self.unifont_subset:
-                        self.cell(w, h, mb_substr(s, j, sep - j, 'UTF-8'), 0, 2, '', 0, link)
-                    else:
-                        self.cell(w, h, substr(s, j, sep - j), 0, 2, '', 0, link)
-                    i = sep + 1
-                sep = -1
-                j = i
-                l = 0
-                if nl == 1:
-                    self.x = self.l_margin
-                    w = self.w - self.r_margin - self.x
-                    wmax = (w - 2 * self.c_margin)
-                nl += 1
+                    start = i + 1
+                    nl += 1
+                    continue
+                if i == j:
+                    i += 1
+                end = start = i
             else:
-                i += 1
-                #Last chunk
-        if i != j:
+                #Automatic line break at the last space
+                end = sep
+                start = sep + 1
+            line = chars[j:end]
             if self.unifont_subset:
-                self.cell(l, h, mb_substr(s, j, i - j, 'UTF-8'), 0, 0, '', 0, link)
-            else:
-                self.cell(l, h, substr(s, j), 0, 0, '', 0, link)
+                line = line.encode('UTF-8')
+            self.cell(w, h, line, 0, 2, '', 0, link)
+            j = start
+            if nl == 1:
+                self.x = self.l_margin
+                w = self.w - self.r_margin - self.x
+                wmax = (w - 2 * self.c_margin)
+            nl += 1
+        #Last chunk
+        if j != nb:
+            line = chars[j:nb]
+            if self.unifont_subset:
+                line = line.encode('UTF-8')
+            self.cell((widths[nb] - widths[j]) * self.font_size / 1000.0, h, line, 0, 0, '', 0, link)
 
     def ln(self, h=''):
         """Line Feed; default value is last cell height"""
@@ -1082,40 +1354,20 @@ class TTFPDF:
                     self.error('Image file has no extension and no type was specified: ' + file)
                 type = substr(file, pos + 1)
             type = type.lower()
-            if type == 'jpg' or type == 'jpeg':
-                info = self._parsejpg(file)
-            elif type == 'png':
-                info = self._parsepng(file)
-            elif type == 'gif':
-                info = self._parsegif(file)
-            else:
-                #Allow for additional formats
-                #maybe the image is not showing the correct extension,
-                #but the header is OK,
-                succeed_parsing = False
-                #try all the parsing functions
-                parsing_functions = [self._parsejpg, self._parsepng, self._parsegif]
-                for pf in parsing_functions:
-                    try:
-                        info = pf(file)
-                        succeed_parsing = True
-                        break
-                    except:
-                        pass
-
-                #last resource
-                if not succeed_parsing:
-                    mtd = '_parse' + type
-                    if not (hasattr(self, mtd) and callable(getattr(self, mtd))):
-                        self.error('Unsupported image type: ' + type)
-                    info = getattr(self, mtd)(file)
+            info = self._getimage(file, type)
 
             if is_mask:
                 info['cs'] = "DeviceGray"  # try to force grayscale (instead of indexed)
 
-            info['i'] = len(self.images) + 1
             if mask_img > 0:
                 info['masked'] = mask_img
+            #The same image under another name or file object is only embedded once
+            key = self._getimagekey(info)
+            if key in self.image_keys:
+                info = self.image_keys[key]
+            else:
+                info['i'] = len(self.image_keys) + 1
+                self.image_keys[key] = info
             self.images[file] = info
         else:
             info = self.images[file]
@@ -1155,6 +1407,71 @@ class TTFPDF:
 
         return info.get('i')
 
+    def _getimage(self, file, type):
+        """Parsed image info, shared by all documents while the file is unchanged"""
+        key = None
+        if isinstance(file, basestring) and os.path.isfile(file):
+            stat = os.stat(file)
+            #The soft mask of a PNG is compressed at the image level while the file is parsed
+            key = (os.path.abspath(file), stat.st_mtime, stat.st_size, type, self.compression_levels['image'])
+            info = IMAGE_CACHE.get(key)
+            if info is not None:
+                if 'smask' in info and self.pdf_version < '1.4':
+                    self.pdf_version = '1.4'
+                #Documents add their own keys to the info and delete the data once it is written
+                return dict(info)
+        info = self._parseimage(file, type)
+        if key is not None:
+            #The documents using the image share its digest
+            self._setimagedigest(info)
+            IMAGE_CACHE.set(key, dict(info))
+        return info
+
+    def _getimagekey(self, info):
+        """Key identifying the content of an image, whatever its name"""
+        if 'digest' not in info:
+            self._setimagedigest(info)
+        attributes = sorted((k, v) for k, v in info.iteritems() if k not in ('data', 'smask'))
+        return 'smask' in info, repr(attributes)
+
+    def _setimagedigest(self, info):
+        """Keep the digest of the data and soft mask of an image in its info"""
+        digest = hashlib.sha1(info['data'])
+        if 'smask' in info:
+            digest.update(hashlib.sha1(info['smask']).digest())
+        info['digest'] = digest.digest()
+
+    def _parseimage(self, file, type):
+        """Extract info from an image file of the given type"""
+        if type == 'jpg' or type == 'jpeg':
+            info = self._parsejpg(file)
+        elif type == 'png':
+            info = self._parsepng(file)
+        elif type == 'gif':
+            info = self._parsegif(file)
+        else:
+            #Allow for additional formats
+            #maybe the image is not showing the correct extension,
+            #but the header is OK,
+            succeed_parsing = False
+            #try all the parsing functions
+            parsing_functions = [self._parsejpg, self._parsepng, self._parsegif]
+            for pf in parsing_functions:
+                try:
+                    info = pf(file)
+                    succeed_parsing = True
+                    break
+                except:
+                    pass
+
+            #last resource
+            if not succeed_parsing:
+                mtd = '_parse' + type
+                if not (hasattr(self, mtd) and callable(getattr(self, mtd))):
+                    self.error('Unsupported image type: ' + type)
+                info = getattr(self, mtd)(file)
+        return info
+
     def image_png_with_alpha(self, file, x, y, w, h, link):
         self.error('Unsupported Alpha Chanel PNG, Yet..')
 
@@ -1192,6 +1509,11 @@ class TTFPDF:
         #Finish document if necessary
         if self.state < 3:
             self.close()
+        if self.stream_to is not None:
+            #Document was already written to the stream
+            if name or dest:
+                self.error('Output destination not available when streaming: ' + (dest or name))
+            return ''
             #Normalize parameters
         dest = dest.upper()
         if dest == '':
@@ -1202,24 +1524,40 @@ class TTFPDF:
                 dest = 'F'
         if dest == 'I':
             #Send to standard output
-            print self.buffer
+            print self.buffer.getvalue()
         elif dest == 'D':
             #Download file
-            print self.buffer
+            print self.buffer.getvalue()
         elif dest == 'F':
             #Save to local file
             f = file(name, 'wb')
             if not f:
                 self.error('Unable to create output file: ' + name)
-            f.write(self.buffer)
+            f.write(self.buffer.getvalue())
             f.close()
         elif dest == 'S':
             #Return as a string
-            return self.buffer
+            return self.buffer.getvalue()
         else:
             self.error('Incorrect output destination: ' + dest)
         return ''
 
+    def _encode_text(self, txt):
+        """Encode UTF-8 text as an escaped UTF-16BE string and add its characters to the font subset"""
+        cache = self.encode_cache
+        if cache is not None:
+            key = (self.font_family + self.font_style, txt)
+            txt2 = cache.get(key)
+            if txt2 is not None:
+                #The characters are already in the subset of the font
+                return txt2
+        u = txt.decode('UTF-8')
+        self.current_font['subset'].update(map(ord, u))
+        txt2 = self._escape(u.encode('UTF-16BE'))
+        if cache is not None:
+            cache.set(key, txt2)
+        return txt2
+
     def UTF8_string_to_array(self, s):
         """Converst an UTF-8 string to ord() list"""
         out = []
@@ -2001,31 +2339,129 @@ class TTFPDF:
             self.aligns = [a for _ in len(self.widths)]
 
     def row(self, data, min_height=0):
-        #Calculate the height of the row
-        nb = 0
-        for i in xrange(len(data)):
-            nb = max(nb, self.nb_lines(self.widths[i], data[i]))
-
-        h = max(5 * nb, min_height)
+        #Break the text of each cell once, the height of the row is the tallest cell
+        layouts = [self.layout_multi_cell(self.widths[i], 5, data[i]) for i in xrange(len(data))]
+        h = min_height
+        for layout in layouts:
+            h = max(h, layout.height)
         #Issue a page break first if needed
         self.check_page_break(h)
-
-        #Draw the cells of the row
-        for i in xrange(len(data)):
-            w = self.widths[i]
-            a = self.aligns[i] if len(self.aligns) >= i + 1 else 'L'
-            #Save the current position
-            x = self.get_x()
-            y = self.get_y()
-            #Draw the border
-            self.rect(x, y, w, h)
-            #Print the text
-            self.multi_cell(w, 5, data[i], 0, a)
-            #Put the position to the right of the cell
-            self.set_xy(x + w, y)
+        self._draw_row(layouts, self.widths, self.aligns, h)
         self.ln(h)
         return h
 
+    def table(self, rows, widths=None, aligns=None, header=None, h=5, min_height=0):
+        """Output a table row by row, the header is repeated at the top of every page"""
+        for _ in self.iter_table(rows, widths, aligns, header, h, min_height):
+            pass
+
+    def iter_table(self, rows, widths=None, aligns=None, header=None, h=5, min_height=0):
+        """Output a table from any iterator of rows, one page at a time
+
+        Rows are read only as far as the current page goes. The page number is yielded each time
+        a page of the table is done, the last one when the rows run out. Unicode cells are
+        encoded for the current font, other cells which are not strings are converted with
+        str() and None gives an empty cell.
+        """
+        if widths is None:
+            widths = self.widths
+        if aligns is None:
+            aligns = self.aligns
+        layout_multi_cell = self.layout_multi_cell
+        draw_row = self._draw_row
+        cell_text = self._table_text
+        if header is not None:
+            header_layouts = [layout_multi_cell(widths[i], h, cell_text(header[i])) for i in xrange(len(header))]
+            header_h = min_height
+            for layout in header_layouts:
+                header_h = max(header_h, layout.height)
+            self.check_page_break(header_h)
+            draw_row(header_layouts, widths, aligns, header_h)
+            self.ln(header_h)
+        #Rows waiting to be drawn on the current page and the position below them
+        page = []
+        y = self.y
+        for data in rows:
+            layouts = []
+            row_h = min_height
+            for i in xrange(len(data)):
+                layout = layout_multi_cell(widths[i], h, cell_text(data[i]))
+                if layout.height > row_h:
+                    row_h = layout.height
+                layouts.append(layout)
+            if y + row_h > self.page_break_trigger:
+                for cells, cells_h in page:
+                    draw_row(cells, widths, aligns, cells_h)
+                    self.ln(cells_h)
+                page = []
+                if self.y + row_h > self.page_break_trigger:
+                    yield self.page
+                    self.add_page(self.cur_orientation)
+                    if header is not None:
+                        draw_row(header_layouts, widths, aligns, header_h)
+                        self.ln(header_h)
+                y = self.y
+            page.append((layouts, row_h))
+            y += row_h
+        for layouts, row_h in page:
+            draw_row(layouts, widths, aligns, row_h)
+            self.ln(row_h)
+        yield self.page
+
+    def _table_text(self, txt):
+        """Get the text of a table cell as a string in the encoding of the current font"""
+        if isinstance(txt, str):
+            return txt
+        if isinstance(txt, unicode):
+            return txt.encode('UTF-8' if self.unifont_subset else 'latin-1')
+        return '' if txt is None else str(txt)
+
+    def _draw_row(self, layouts, widths, aligns, h):
+        """Output the cells of a table row of height h at the current position"""
+        x = self.x
+        y = self.y
+        if y + h > self.page_break_trigger:
+            #The row does not fit on the page, let the cells break it
+            for i in xrange(len(layouts)):
+                w = widths[i]
+                self.rect(x, y, w, h)
+                self.draw_multi_cell(layouts[i], 0, aligns[i] if len(aligns) >= i + 1 else 'L')
+                self.set_xy(x + w, y)
+                x = self.x
+                y = self.y
+            return
+        #Collect the borders and the text of all cells, the row is written at once
+        k = self.k
+        ops = []
+        add = ops.append
+        for i in xrange(len(layouts)):
+            w = widths[i]
+            a = aligns[i] if len(aligns) >= i + 1 else 'L'
+            layout = layouts[i]
+            add(sprintf('%.2f %.2f %.2f %.2f re S', x * k, (self.h - y) * k, w * k, -h * k))
+            self.x = x
+            self.y = y
+            for line, ns, ls in layout.breaks:
+                if ns is None:
+                    if self.ws > 0:
+                        self.ws = 0
+                        add('0 Tw')
+                elif a == 'J':
+                    if ns > 1:
+                        self.ws = (layout.wmax - ls) / (ns - 1)
+                    else:
+                        self.ws = 0
+                    add(sprintf('%.3f Tw', self.ws * k))
+                s = self._cell_ops(layout.w, layout.h, line, 0, a, 0, '')
+                if s:
+                    add(s)
+                self.y += layout.h
+                self.lasth = layout.h
+            x += w
+        self._out("\n".join(ops))
+        self.x = x
+        self.y = y
+
     def check_page_break(self, h):
         #If the height h would cause an overflow, add a new page immediately
         if self.get_y() + h > self.page_break_trigger:
@@ -2033,43 +2469,7 @@ class TTFPDF:
 
     def nb_lines(self, w, txt):
         #Computes the number of lines a MultiCell of width w will take
-        if w == 0:
-            w = self.w - self.r_margin - self.x
-        wmax = (w - 2 * self.c_margin) * 1000 / self.font_size
-        s = txt.replace("\r", "")
-        nb = len(s)
-        if nb > 0 and s[nb - 1] == "\n":
-            nb -= 1
-        sep = -1
-        i = 0
-        j = 0
-        l = 0
-        nl = 1
-        while i < nb:
-            c = s[i]
-            if c == "\n":
-                i += 1
-                sep = -1
-                j = i
-                l = 0
-                nl += 1
-                continue
-            if c == ' ':
-                sep = i
-            l += self.get_string_width(c) * 1000.0 / self.font_size
-            if l > wmax:
-                if sep == -1:
-                    if i == j:
-                        i += 1
-                else:
-                    i = sep + 1
-                sep = -1
-                j = i
-                l = 0
-                nl += 1
-            else:
-                i += 1
-        return nl
+        return len(self.layout_multi_cell(w, 0, txt).lines)
 
 
     # ******************************************************************************
@@ -2110,7 +2510,7 @@ class TTFPDF:
     def _beginpage(self, orientation, size):
         """Starts a new pdf page"""
         self.page += 1
-        self.pages[self.page] = ''
+        self.pages[self.page] = PDFBuffer()
         self.state = 2
         self.x = self.l_margin
         self.y = self.t_margin
@@ -2144,6 +2544,77 @@ class TTFPDF:
     def _endpage(self):
         """End of page contents"""
         self.state = 1
+        if self.flush_pages:
+            self._flushpage(self.page)
+
+    def _flushpage(self, n):
+        """Write the content of a finished page, the /Page dictionary follows in _putpages"""
+        if hasattr(self, 'str_alias_nb_pages'):
+            page = self.pages[n].getvalue()
+            if self._findnbalias(page, 0)[0] != -1:
+                #The total number of pages is not known yet, the content up to the first total is
+                #written now and the rest at close() in a second stream
+                split = self._splitnbalias(page)
+                if split is None:
+                    #The alias is not in a text string, keep the page until close()
+                    return
+                page, self.page_tails[n] = split
+                self.pages[n] = PDFBuffer(page)
+        if not self.offset:
+            self._putheader()
+        page = self.pages.pop(n).getvalue()
+        if not self.compress:
+            self._putpagecontent(n, page)
+        elif self.compress_workers > 1:
+            #Compress in the background, contents are still written in page order
+            self.pending_pages.append((n, self._getpool().apply_async(self._compress, (page, 'page'))))
+            if len(self.pending_pages) > self.compress_workers:
+                n, result = self.pending_pages.pop(0)
+                self._putpagecontent(n, result.get())
+        else:
+            self._putpagecontent(n, self._compress(page, 'page'))
+
+    def _findnbalias(self, page, start):
+        """Position and encoding ('utf16' or 'plain') of the next alias for the number of pages"""
+        pos = page.find(self.UTF8_to_UTF16BE(self.str_alias_nb_pages, False), start)
+        plain = page.find(self.str_alias_nb_pages, start)
+        if plain != -1 and (pos == -1 or plain < pos):
+            return plain, 'plain'
+        return pos, 'utf16'
+
+    def _splitnbalias(self, page):
+        """Split page content at the first alias for the number of pages
+
+        Returns the content before the alias and the content from the alias on, or None if the
+        alias is not inside a shown text string. The string holding the alias is closed before it
+        and reopened at the start of the second part, so the text keeps its position.
+        """
+        pos, encoding = self._findnbalias(page, 0)
+        end = pos + len(self.str_alias_nb_pages if encoding == 'plain' else
+                        self.UTF8_to_UTF16BE(self.str_alias_nb_pages, False))
+        #Find the end of the string holding the alias
+        i = end
+        while i < len(page) and page[i] != ')':
+            i += 2 if page[i] == '\\' else 1
+        if i >= len(page):
+            return None
+        following = page[i + 1:i + 20].lstrip(' ')
+        if following.startswith('Tj'):
+            close, reopen = ') Tj\n', '('
+        elif following[:1] in ('-', '(', ']') or following[:1].isdigit():
+            #Inside the array of a TJ operator
+            close, reopen = ')] TJ\n', '[('
+        else:
+            return None
+        return page[:pos] + close, reopen + page[pos:]
+
+    def _replacenbalias(self, page, nb):
+        """Replace the aliases for the number of pages in page content"""
+        # Replace number of pages in fonts using subsets
+        alias = self.UTF8_to_UTF16BE(self.str_alias_nb_pages, False)
+        page = page.replace(alias, self.UTF8_to_UTF16BE(str(nb), False))
+        #Now repeat for no pages in non-subset fonts
+        return page.replace(self.str_alias_nb_pages, str(nb))
 
     def _loadfont(self, font):
         """Load a font definition file from the font directory"""
@@ -2272,12 +2743,12 @@ class TTFPDF:
         #Read header chunk
         f.read(4)
         if f.read(4) != 'IHDR':
-            self.error('Incorrect PNG file: ' + name)
+            self.error('Incorrect PNG file: ' + str(name))
         w = self._freadint(f)
         h = self._freadint(f)
         bpc = ord(f.read(1))
         if bpc > 8:
-            self.error('16-bit depth not supported: ' + name)
+            self.error('16-bit depth not supported: ' + str(name))
 
         ct = ord(f.read(1))
         if ct == 0 or ct == 4:
@@ -2287,14 +2758,14 @@ class TTFPDF:
         elif ct == 3:
             colspace = 'Indexed'
         else:
-            self.error('Alpha channel not supported: ' + name)
+            self.error('Alpha channel not supported: ' + str(name))
 
         if ord(f.read(1)) != 0:
-            self.error('Unknown compression method: ' + name)
+            self.error('Unknown compression method: ' + str(name))
         if ord(f.read(1)) != 0:
-            self.error('Unknown filter method: ' + name)
+            self.error('Unknown filter method: ' + str(name))
         if ord(f.read(1)) != 0:
-            self.error('Interlacing not supported: ' + name)
+            self.error('Interlacing not supported: ' + str(name))
 
         f.read(4)
         dp = '/Predictor 15 /Colors '
@@ -2307,7 +2778,7 @@ class TTFPDF:
         #Scan chunks looking for palette, transparency and image data
         pal = ''
         trns = ''
-        data = ''
+        chunks = []
         n = 1
         while n != None:
             n = self._freadint(f)
@@ -2330,50 +2801,45 @@ class TTFPDF:
                 f.read(4)
             elif type == 'IDAT':
                 #Read image data block
-                data += f.read(n)
+                chunks.append(f.read(n))
                 f.read(4)
             elif type == 'IEND':
                 break
             else:
                 f.read(n + 4)
         if colspace == 'Indexed' and not pal:
-            self.error('Missing palette in ' + name)
+            self.error('Missing palette in ' + str(name))
         f.close()
         info = {'w': w, 'h': h, 'cs': colspace, 'bpc': bpc, 'f': 'FlateDecode', 'dp': dp, 'pal': pal, 'trns': trns}
         if ct >= 4:
             # Extract alpha channel
-            data = zlib.decompress(data)
-            color = ''
-            alpha = ''
-            if ct == 4:
-                # Gray image
-                length = 2 * w
-                for i in xrange(h):
-                    pos = (1 + length) * i
-                    color += data[pos]
-                    alpha += data[pos]
-                    line = substr(data, pos + 1, length)
-                    color += re.sub('(.).', lambda m: m.group(1), line, flags=re.DOTALL)
-                    alpha += re.sub('.(.)', lambda m: m.group(1), line, flags=re.DOTALL)
-            else:
-                # RGB image
-                length = 4 * w
-                for i in xrange(h):
-                    pos = (1 + length) * i
-                    color += data[pos]
-                    alpha += data[pos]
-                    line = substr(data, pos + 1, length)
-                    color += re.sub('(.{3}).', lambda m: m.group(1), line, flags=re.DOTALL)
-                    alpha += re.sub('.{3}(.)', lambda m: m.group(1), line, flags=re.DOTALL)
-            del data
-            data = zlib.compress(color)
-            info['smask'] = zlib.compress(alpha)
+            data, info['smask'] = self._getpngalpha(name, chunks, w, h, ct)
             if self.pdf_version < '1.4':
                 self.pdf_version = '1.4'
+        else:
+            data = ''.join(chunks)
 
         info['data'] = data
         return info
 
+    def _getpngalpha(self, name, chunks, w, h, ct):
+        """Compressed color and alpha streams of a PNG image with an alpha channel"""
+        digest = hashlib.sha1()
+        for chunk in chunks:
+            digest.update(chunk)
+        key = (digest.digest(), w, h, ct, self.compression_levels['image'])
+        value = PNG_ALPHA_CACHE.get(key)
+        if value is None:
+            level, strategy = self.compression_levels['image']
+            splitter = PNGAlphaSplitter(w, h, 2 if ct == 4 else 4, level, strategy)
+            for chunk in chunks:
+                splitter.feed(chunk)
+            value = splitter.close()
+            if value is None:
+                self.error('Incorrect PNG file: ' + str(name))
+            PNG_ALPHA_CACHE.set(key, value)
+        return value
+
     def _freadint(self, f):
         """Read a 4-byte integer from file"""
         try:
@@ -2384,47 +2850,61 @@ class TTFPDF:
     def _newobj(self):
         """Begin a new object"""
         self.n += 1
-        self.offsets[self.n] = len(self.buffer)
+        self.offsets[self.n] = self.offset
         self._out(str(self.n) + ' 0 obj')
 
     def _putstream(self, s):
         if self.encrypted:
             s = self._rc4(self._objectkey(self.n), s)
         self._out('stream')
-        self._out(s)
+        #Avoid copying big streams just to append the line feed
+        self._write(s)
+        self._write("\n")
         self._out('endstream')
 
     def _out(self, s):
         """Add a line to the document"""
         if self.state == 2:
-            self.pages[self.page] += s + "\n"
+            self.pages[self.page].write(s + "\n")
+        else:
+            self._write(str(s) + "\n")
+
+    def _write(self, s):
+        """Add raw data to the document"""
+        self.offset += len(s)
+        if self.stream_to is not None:
+            self.stream_to.write(s)
         else:
-            self.buffer += str(s) + "\n"
+            self.buffer.write(s)
 
     def _putpages(self):
         """Add each page content to the pdf"""
         nb = self.page
+        for n, result in self.pending_pages:
+            self._putpagecontent(n, result.get())
+        self.pending_pages = []
         if hasattr(self, 'str_alias_nb_pages'):
-            # Replace number of pages in fonts using subsets
-            alias = self.UTF8_to_UTF16BE(self.str_alias_nb_pages, False)
-            r = self.UTF8_to_UTF16BE(str(nb), False)
-            for n in xrange(1, nb + 1):
-                self.pages[n] = self.pages[n].replace(alias, r)
-                #Now repeat for no pages in non-subset fonts
-            for n in xrange(1, nb + 1):
-                self.pages[n] = self.pages[n].replace(self.str_alias_nb_pages, str(nb))
+            for n in self.pages:
+                self.pages[n] = PDFBuffer(self._replacenbalias(self.pages[n].getvalue(), nb))
         if self.def_orientation == 'P':
             w_pt = self.def_page_size[0] * self.k
             h_pt = self.def_page_size[1] * self.k
         else:
             w_pt = self.def_page_size[1] * self.k
             h_pt = self.def_page_size[0] * self.k
+        #Content from the first total on of the pages flushed before it was known
+        tails = sorted(self.page_tails)
+        tail_objects = dict((n, 2 * nb + 3 + i) for i, n in enumerate(tails))
+        #Contents of the pages not flushed yet, in page order
+        remaining = sorted(self.pages)
+        contents = [self.pages.pop(n).getvalue() for n in remaining]
         if self.compress:
-            filter = '/Filter /FlateDecode '
-        else:
-            filter = ''
+            contents = self._compress_iter(contents, 'page')
+        contents = iter(contents)
+        remaining = set(remaining)
         for n in xrange(1, nb + 1):
-            #Page
+            #Page, objects 2n+1 and 2n+2 are reserved for the page and its content
+            self.n = 2 * n
             self._newobj()
             self._out('<</Type /Page')
             self._out('/Parent 1 0 R')
@@ -2449,19 +2929,20 @@ class TTFPDF:
                 self._out(annots + ']')
             if self.pdf_version > '1.3':
                 self._out('/Group <</Type /Group /S /Transparency /CS /DeviceRGB>>')
-            self._out('/Contents ' + str(self.n + 1) + ' 0 R>>')
-            self._out('endobj')
-            #Page content
-            if self.compress:
-                p = zlib.compress(self.pages[n])
+            if n in tail_objects:
+                self._out(sprintf('/Contents [%d 0 R %d 0 R]>>', self.n + 1, tail_objects[n]))
             else:
-                p = self.pages[n]
-            self._newobj()
-            self._out('<<' + filter + '/Length ' + str(len(p)) + '>>')
-            self._putstream(p)
+                self._out('/Contents ' + str(self.n + 1) + ' 0 R>>')
             self._out('endobj')
+            #Page content, unless it was already flushed
+            if n in remaining:
+                self._putpagecontent(n, contents.next())
+        self.n = 2 * nb + 2
+        for n in tails:
+            self._putcontent(self._replacenbalias(self.page_tails[n], nb))
+        self.page_tails = {}
             #Pages root
-        self.offsets[1] = len(self.buffer)
+        self.offsets[1] = self.offset
         self._out('1 0 obj')
         self._out('<</Type /Pages')
         kids = '/Kids ['
@@ -2473,6 +2954,25 @@ class TTFPDF:
         self._out('>>')
         self._out('endobj')
 
+    def _putpagecontent(self, n, p):
+        """Add the (compressed) content p of page n as object 2n+2"""
+        self.n = 2 * n + 1
+        self._putcontentstream(p)
+
+    def _putcontent(self, p):
+        """Add page content p as a new object, compressing it if needed"""
+        if self.compress:
+            p = self._compress(p, 'page')
+        self._putcontentstream(p)
+
+    def _putcontentstream(self, p):
+        """Add the (compressed) content stream p as a new object"""
+        filter = self.compress and '/Filter /FlateDecode ' or ''
+        self._newobj()
+        self._out('<<' + filter + '/Length ' + str(len(p)) + '>>')
+        self._putstream(p)
+        self._out('endobj')
+
     def _putfonts(self):
         """Add fonts to the pdf file"""
         nf = self.n
@@ -2569,19 +3069,10 @@ class TTFPDF:
                 #TrueType embedded SUBSETS or FULL
             elif type == 'TTF':
                 self.fonts[k]['n'] = self.n + 1
-                from font.unitfont import TTFontFile
-
-                ttf = TTFontFile()
                 font_name = 'MPDFAA' + '+' + font['name']
                 subset = font['subset']
-                if 0 in subset:
-                    del subset[0]
-                ttf_font_stream = ttf.make_subset(font['ttffile'], subset)
-                ttf_font_size = len(ttf_font_stream)
-                font_stream = zlib.compress(ttf_font_stream)
-                code_to_glyph = ttf.code_to_glyph
-                if 0 in code_to_glyph:
-                    del code_to_glyph[0]
+                subset.discard(0)
+                font_stream, ttf_font_size, code_to_glyph, max_uni = self._getsubset(font['ttffile'], subset)
 
                 #// Type0 Font
                 #// A composite font - a font composed of other fonts, organized hierarchically
@@ -2606,7 +3097,7 @@ class TTFPDF:
                 if 'desc' in font and 'MissingWidth' in font['desc']:
                     self._out('/DW ' + str(font['desc']['MissingWidth']))
 
-                self._putTTfontwidths(font, ttf.max_uni)
+                self._putTTfontwidths(font, max_uni)
 
                 self._out('/CIDToGIDMap ' + str(self.n + 4) + ' 0 R')
                 self._out('>>')
@@ -2662,11 +3153,7 @@ class TTFPDF:
 
                 #// Embed CIDToGIDMap
                 #// A specification of the mapping from CIDs to glyph indices
-                cid_to_gidmap = ["\x00" for _i in xrange(256 * 256 * 2)]
-                for cc, glyph in code_to_glyph.iteritems():
-                    cid_to_gidmap[cc * 2] = chr(glyph >> 8)
-                    cid_to_gidmap[cc * 2 + 1] = chr(glyph & 0xFF)
-                cid_to_gidmap = zlib.compress(''.join(cid_to_gidmap))
+                cid_to_gidmap = self._getcidtogidmap(font['ttffile'], code_to_glyph, max_uni)
                 self._newobj()
                 self._out('<</Length ' + str(len(cid_to_gidmap)))
                 self._out('/Filter /FlateDecode')
@@ -2682,7 +3169,6 @@ class TTFPDF:
                 self._out('>>')
                 self._putstream(font_stream)
                 self._out('endobj')
-                del ttf
             else:
                 #Allow for additional types
                 mtd = '_put' + type.lower()
@@ -2690,6 +3176,35 @@ class TTFPDF:
                     self.error('Unsupported font type: ' + type)
                 self.mtd(font)
 
+    def _getsubset(self, ttffile, subset):
+        """Compressed font subset, its length, code to glyph mapping and highest code point"""
+        key = (ttffile, os.path.getmtime(ttffile), frozenset(subset), self.compression_levels['font'])
+        value = SUBSET_CACHE.get(key)
+        if value is None:
+            from font.unitfont import TTFontFile
+
+            ttf = TTFontFile()
+            ttf_font_stream = ttf.make_subset(ttffile, sorted(subset))
+            code_to_glyph = ttf.code_to_glyph
+            if 0 in code_to_glyph:
+                del code_to_glyph[0]
+            value = (self._compress(ttf_font_stream, 'font'), len(ttf_font_stream), code_to_glyph, ttf.max_uni)
+            SUBSET_CACHE.set(key, value)
+        return value
+
+    def _getcidtogidmap(self, ttffile, code_to_glyph, max_uni):
+        """Compressed CIDToGIDMap, it only covers the CIDs up to the highest one used"""
+        key = (ttffile, frozenset(code_to_glyph.iteritems()), max_uni, self.compression_levels['cidtogidmap'])
+        cid_to_gidmap = CID_TO_GID_MAP_CACHE.get(key)
+        if cid_to_gidmap is None:
+            cid_to_gidmap = bytearray(2 * (max_uni + 1))
+            for cc, glyph in code_to_glyph.iteritems():
+                cid_to_gidmap[cc * 2] = glyph >> 8
+                cid_to_gidmap[cc * 2 + 1] = glyph & 0xFF
+            cid_to_gidmap = self._compress(str(cid_to_gidmap), 'cidtogidmap')
+            CID_TO_GID_MAP_CACHE.set(key, cid_to_gidmap)
+        return cid_to_gidmap
+
     def _putTTfontwidths(self, font, max_uni):
         if os.path.exists(font['unifilename'] + '.cw127.py'):
             imports = {}
@@ -2709,7 +3224,8 @@ class TTFPDF:
             interval = False
             start_cid = 1
 
-        cw_len = max_uni + 1
+        cw = font['cw']
+        cw_len = min(max_uni + 1, len(cw))
         #for each character
         for cid in xrange(start_cid, cw_len):
             if cid == 128 and not os.path.exists(font['unifilename'] + '.cw127.py'):
@@ -2728,12 +3244,12 @@ class TTFPDF:
                     fh.write(cw127)
                     fh.close()
 
-            if font['cw'][cid * 2] == "\00" and font['cw'][cid * 2 + 1] == "\00":
+            width = cw[cid]
+            if not width:
                 continue
-            width = (ord(font['cw'][cid * 2]) << 8) + ord(font['cw'][cid * 2 + 1])
             if width == 65535:
                 width = 0
-            if cid > 255 and (cid not in font['subset'] or not font['subset'][cid]):
+            if cid > 255 and cid not in font['subset']:
                 continue
             if 'dw' not in font or 'dw' in font and width != font['dw']:
                 if cid == prev_cid + 1:
@@ -2852,7 +3368,7 @@ class TTFPDF:
                 self._newobj()
                 filter = self.compress and '/Filter /FlateDecode ' or ''
                 if self.compress:
-                    pal = zlib.compress(info['pal'])
+                    pal = self._compress(info['pal'], 'image')
                 else:
                     pal = info['pal']
                 self._out('<<' + filter + '/Length ' + str(len(pal)) + '>>')
@@ -2861,14 +3377,20 @@ class TTFPDF:
 
     def _putimages(self):
         for filename, info in self.images.iteritems():
+            if 'data' not in info:
+                #Same image as another name, already written
+                continue
             self._putimage(info)
             del info['data']
             if 'smask' in info:
                 del info['smask']
 
     def _putxobjectdict(self):
+        written = set()
         for image in self.images.values():
-            self._out('/I' + str(image['i']) + ' ' + str(image['n']) + ' 0 R')
+            if image['i'] not in written:
+                written.add(image['i'])
+                self._out('/I' + str(image['i']) + ' ' + str(image['n']) + ' 0 R')
 
     def _putresourcedict(self):
         self._out('/ProcSet [/PDF /Text /ImageB /ImageC /ImageI]')
@@ -2892,7 +3414,7 @@ class TTFPDF:
         self._putfonts()
         self._putimages()
         #Resource dictionary
-        self.offsets[2] = len(self.buffer)
+        self.offsets[2] = self.offset
         self._out('2 0 obj')
         self._out('<<')
         self._putresourcedict()
@@ -2943,8 +3465,12 @@ class TTFPDF:
 
         if self.files:
             self._out('/Names <</EmbeddedFiles ' + str(self.n_files) + ' 0 R>>')
+        if self.pdf_version > self.header_version:
+            #Header was written with the first flushed page, before the version was raised
+            self._out('/Version /' + self.pdf_version)
 
     def _putheader(self):
+        self.header_version = self.pdf_version
         self._out('%PDF-' + self.pdf_version)
 
     def _puttrailer(self):
@@ -2965,13 +3491,17 @@ class TTFPDF:
 
     def _putfiles(self):
         s = ''
-        for i, info in enumerate(self.files):
-            file = info['file']
+        #Files are read one at a time as they are written
+        contents = itertools.imap(self._readattachment, self.files)
+        if self.compress:
+            if self.compress_workers > 1:
+                #Read them all first to compress them in parallel
+                contents = self._compress_iter(list(contents), 'file')
+            else:
+                contents = itertools.imap(lambda fc: self._compress(fc, 'file'), contents)
+        for i, (info, fc) in enumerate(itertools.izip(self.files, contents)):
             name = info['name']
             desc = info['desc']
-            if hasattr(file, 'seek') and callable(getattr(file, 'seek')):
-                file.seek(0)
-            fc = file.read()
 
             self._newobj()
             s += '(' + self._escape(sprintf('%03d', i)) + ') ' + str(self.n) + ' 0 R '
@@ -2988,7 +3518,6 @@ class TTFPDF:
             self._out('<<')
             self._out('/Type /EmbeddedFile')
             if self.compress:
-                fc = zlib.compress(fc, 9)
                 self._out('/Filter /FlateDecode')
             self._out('/Length ' + str(len(fc)))
             self._out('>>')
@@ -3002,8 +3531,16 @@ class TTFPDF:
         self._out('>>')
         self._out('endobj')
 
+    def _readattachment(self, info):
+        """Read the content of an attached file"""
+        file = info['file']
+        if hasattr(file, 'seek') and callable(getattr(file, 'seek')):
+            file.seek(0)
+        return file.read()
+
     def _enddoc(self):
-        self._putheader()
+        if not self.offset:
+            self._putheader()
         self._putpages()
         self._putresources()
         #Info
@@ -3019,7 +3556,7 @@ class TTFPDF:
         self._out('>>')
         self._out('endobj')
         #Cross-ref
-        o = len(self.buffer)
+        o = self.offset
         self._out('xref')
         self._out('0 ' + (str(self.n + 1)))
         self._out('0000000000 65535 f ')
@@ -3034,6 +3571,32 @@ class TTFPDF:
         self._out(o)
         self._out('%%EOF')
         self.state = 3
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def _getpool(self):
+        """Thread pool compressing streams, zlib releases the GIL while it works"""
+        if self.pool is None:
+            from multiprocessing.pool import ThreadPool
+
+            self.pool = ThreadPool(self.compress_workers)
+        return self.pool
+
+    def _compress(self, s, stream):
+        """Compress a string with the level and strategy set for its kind of stream"""
+        level, strategy = self.compression_levels[stream]
+        if strategy == zlib.Z_DEFAULT_STRATEGY:
+            return zlib.compress(s, level)
+        c = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 8, strategy)
+        return c.compress(s) + c.flush()
+
+    def _compress_iter(self, items, stream):
+        """Compress strings, results come in order even when compressed in parallel"""
+        compress = lambda s: self._compress(s, stream)
+        if self.compress_workers > 1 and len(items) > 1:
+            return self._getpool().imap(compress, items)
+        return itertools.imap(compress, items)
 
     def _generateencryptionkey(self, user_pass, owner_pass, protection):
         """Compute encryption key"""